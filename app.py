@@ -1,9 +1,14 @@
 import streamlit as st
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.globals import get_llm_cache, set_llm_cache
 from dotenv import load_dotenv
 import os
-import json
+import uuid
+from streaming_json import StreamingJsonParser
+from llm_cache import build_llm_cache, build_recipe_cache
+from favorites import FavoritesStore
 
 load_dotenv()
 openai_api_key = os.getenv("OPENAI_API_KEY")
@@ -14,19 +19,144 @@ if not openai_api_key:
 else:
     print(f"API key found (starts with: {openai_api_key[:4]}...)")
 
-# Define the RecipeState for Streamlit
-class RecipeState:
-    def __init__(self):
-        self.ingredients = []
-        self.dietary_restrictions = []
-        self.preferences = []
-        self.generated_recipe = None
-        self.adjusted_recipe = None
-        self.substitutions = None
-        self.favorites = []
-        self.user_notes = None
+# Favorites are persisted in SQLite; each owner only sees their own rows
+@st.cache_resource
+def get_favorites():
+    return FavoritesStore()
 
-state = RecipeState()
+# Build the chat models once per server process so every rerun and session
+# reuses the same HTTP connection pool. The clients' own retries are disabled
+# since with_retry handles them.
+@st.cache_resource
+def get_llm():
+    # The OpenAI and cache imports take about a second, so they are deferred
+    # until the first LLM call instead of delaying the first page render
+    import openai
+    from langchain_openai import ChatOpenAI
+
+    # Cache LLM responses so repeated prompts skip the OpenAI round-trip
+    set_llm_cache(build_llm_cache())
+
+    primary = ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0,
+        api_key=openai_api_key,
+        max_retries=0,
+        timeout=30,
+        streaming=True
+    )
+    backup = ChatOpenAI(
+        model="gpt-3.5-turbo",
+        temperature=0,
+        api_key=openai_api_key,
+        max_retries=0,
+        timeout=30,
+        streaming=True
+    )
+    # Retry rate limits and dropped connections with exponential backoff, and
+    # fall back to the second model on OpenAI server errors. Only these
+    # exception types are handled, so KeyboardInterrupt and programming
+    # errors still propagate.
+    return primary.with_retry(
+        retry_if_exception_type=(openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError),
+        wait_exponential_jitter=True,
+        stop_after_attempt=4
+    ).with_fallbacks([backup], exceptions_to_handle=(openai.InternalServerError,))
+
+# With REDIS_URL set, recipes for similar inputs (e.g. "tomatoes" vs "tomato")
+# are served from a semantic cache; None otherwise
+@st.cache_resource
+def get_recipe_cache():
+    return build_recipe_cache()
+
+# Output caps bound worst-case latency and cost; recipes are asked to stay
+# under 150 words and the substitutions object is short
+RECIPE_MAX_TOKENS = 400
+SUBSTITUTION_MAX_TOKENS = 150
+
+# Prompts keep the static instructions in a system message so every call
+# shares the same prefix, and ask for short answers to cut output tokens.
+# Mustache templates leave literal braces alone and triple braces insert
+# values without HTML escaping.
+RECIPE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You are a concise chef. Reply in markdown only, under 150 words."),
+    ("human", "Ingredients: {{{ingredients}}}\nRestrictions: {{{restrictions}}}\n"
+              "Preferences: {{{preferences}}}\nReturn: name, ingredients, steps.")
+], template_format="mustache")
+
+# Numbered variations keep each batched prompt distinct, so with temperature 0
+# every variant gets its own cache entry instead of repeating the same recipe
+VARIANT_PROMPT = RECIPE_PROMPT + ChatPromptTemplate.from_messages([
+    ("human", "Variation {{{variant}}} of {{{count}}}: make it clearly different from the others.")
+], template_format="mustache")
+
+ADJUST_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "Adjust the recipe to strictly follow the dietary restrictions with minimal "
+               "substitutions. Keep the same markdown format, under 150 words."),
+    ("human", "Restrictions: {{{restrictions}}}\nRecipe:\n{{{recipe}}}")
+], template_format="mustache")
+
+SUBSTITUTION_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "Suggest ingredient substitutions for the recipe that fit the restrictions and "
+               "preferences. Reply with a JSON object mapping ingredient to substitute, "
+               "e.g. {\"butter\": \"olive oil\"}."),
+    ("human", "Restrictions: {{{restrictions}}}\nPreferences: {{{preferences}}}\n"
+              "Recipe:\n{{{recipe}}}")
+], template_format="mustache")
+
+# Render tokens into a Streamlit placeholder as the model produces them.
+# A callback is used instead of llm.stream() because stream() bypasses the
+# LLM cache, whereas invoke() still returns cached responses instantly.
+class StreamHandler(BaseCallbackHandler):
+    def __init__(self, placeholder):
+        self.placeholder = placeholder
+        self.text = ""
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        # A retry or fallback starts over, so drop any partial output
+        self.text = ""
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.text += token
+        self.placeholder.markdown(self.text)
+
+# Parse the substitutions JSON as it streams and show each pair once complete
+class SubstitutionStreamHandler(BaseCallbackHandler):
+    def __init__(self, placeholder):
+        self.placeholder = placeholder
+        self.parser = StreamingJsonParser()
+        self.substitutions = {}
+        self.streamed = False
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        # A retry or fallback starts over, so drop any partial output
+        self.parser = StreamingJsonParser()
+        self.substitutions = {}
+        self.streamed = False
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.streamed = True
+        self.feed(token)
+
+    def feed(self, text):
+        self.parser.consume(text)
+        substitutions = self.parser.get()
+        if len(substitutions) > len(self.substitutions):
+            self.substitutions = substitutions
+            self.placeholder.table(
+                [{"Ingredient": k, "Substitute": v} for k, v in substitutions.items()]
+            )
+
+# Default recipe state, kept per browser session in st.session_state
+DEFAULT_STATE = {
+    "ingredients": [],
+    "dietary_restrictions": [],
+    "preferences": [],
+    "generated_recipe": None,
+    "adjusted_recipe": None,
+    "substitutions": None,
+    "user_notes": None
+}
 
 # User input section
 def user_input():
@@ -37,41 +167,72 @@ def user_input():
     restrictions_input = st.text_input("Enter dietary restrictions separated by commas (or leave blank)")
     preferences_input = st.text_input("Enter taste or cuisine preferences separated by commas")
 
-    # Update state with user inputs
-    if ingredients_input:
-        state.ingredients = [item.strip() for item in ingredients_input.split(",") if item.strip()]
-    if restrictions_input:
-        state.dietary_restrictions = [item.strip() for item in restrictions_input.split(",") if item.strip()]
-    if preferences_input:
-        state.preferences = [item.strip() for item in preferences_input.split(",") if item.strip()]
+    # Update state with user inputs on every run, so an emptied field clears its
+    # list. Normalized (lowercased, de-duplicated and sorted) so reordered or
+    # repeated input maps to the same cached prompt.
+    st.session_state.ingredients = sorted({item.strip().lower() for item in ingredients_input.split(",") if item.strip()})
+    st.session_state.dietary_restrictions = sorted({item.strip().lower() for item in restrictions_input.split(",") if item.strip()})
+    st.session_state.preferences = sorted({item.strip().lower() for item in preferences_input.split(",") if item.strip()})
 
     if st.button("Generate Recipe"):
         generate_recipe()
 
+    variant_count = st.number_input("Number of recipe variants", min_value=2, max_value=5, value=3)
+    if st.button("Generate Variants"):
+        generate_recipe_variants(variant_count)
+
+def recipe_inputs():
+    return {
+        "ingredients": ', '.join(st.session_state.ingredients),
+        "restrictions": ', '.join(st.session_state.dietary_restrictions) or 'none',
+        "preferences": ', '.join(st.session_state.preferences) or 'none'
+    }
+
+# Inputs that are answered locally without calling the LLM
+def looks_malformed(ingredients):
+    return all(len(item) == 1 or item.isdigit() for item in ingredients)
+
+def simple_recipe(ingredient):
+    return f"# Simple {ingredient} dish\n1. Season the {ingredient}.\n2. Cook until done.\n3. Serve."
+
+def is_simple_request():
+    return (
+        len(st.session_state.ingredients) == 1
+        and not st.session_state.dietary_restrictions
+        and not st.session_state.preferences
+    )
+
+def invoke_recipe_chain(inputs, placeholder):
+    recipe_cache = get_recipe_cache()
+    recipe = recipe_cache.lookup(inputs) if recipe_cache else None
+    if recipe is None:
+        chain = RECIPE_PROMPT | get_llm().bind(max_tokens=RECIPE_MAX_TOKENS) | StrOutputParser()
+        recipe = chain.invoke(inputs, config={"callbacks": [StreamHandler(placeholder)]})
+        if recipe_cache:
+            recipe_cache.update(inputs, recipe)
+    return recipe
+
 # Recipe generation section
 def generate_recipe():
-    if not state.ingredients:
+    if not st.session_state.ingredients:
         st.error("No ingredients provided. Cannot generate recipe.")
         return
-    
-    prompt = f"""You are a helpful chef. Create a recipe with the following ingredients: {', '.join(state.ingredients)}.
-    Make sure the recipe follows these dietary restrictions: {', '.join(state.dietary_restrictions) if state.dietary_restrictions else 'none'} and 
-    try to match these taste preferences: {', '.join(state.preferences) if state.preferences else 'none'}
-    
-    Provide the recipe name, ingredients list and step-by-step instructions.
-    """
+    if looks_malformed(st.session_state.ingredients):
+        st.error("Ingredients look malformed. Enter ingredient names separated by commas.")
+        return
+
+    # A new recipe invalidates anything derived from the previous one
+    st.session_state.adjusted_recipe = None
+    st.session_state.substitutions = None
 
     try:
-        llm = ChatOpenAI(
-            model="gpt-3.5-turbo", 
-            temperature=0.7, 
-            api_key=openai_api_key
-        )
-        
-        response = llm.invoke([HumanMessage(content=prompt)])
-        state.generated_recipe = response.content
         st.subheader("Generated Recipe")
-        st.write(state.generated_recipe)
+        placeholder = st.empty()
+        if is_simple_request():
+            st.session_state.generated_recipe = simple_recipe(st.session_state.ingredients[0])
+        else:
+            st.session_state.generated_recipe = invoke_recipe_chain(recipe_inputs(), placeholder)
+        placeholder.markdown(st.session_state.generated_recipe)
 
         st.button("Adjust Recipe", on_click=adjust_recipe)
         st.button("Suggest Substitutions", on_click=suggest_substitutions)
@@ -79,68 +240,86 @@ def generate_recipe():
     except Exception as e:
         st.error(f"Error generating recipe: {str(e)}")
 
+# Recipe variants section
+def generate_recipe_variants(count):
+    if not st.session_state.ingredients:
+        st.error("No ingredients provided. Cannot generate recipe variants.")
+        return
+    if looks_malformed(st.session_state.ingredients):
+        st.error("Ingredients look malformed. Enter ingredient names separated by commas.")
+        return
+
+    inputs = [
+        {**recipe_inputs(), "variant": number, "count": count}
+        for number in range(1, count + 1)
+    ]
+
+    try:
+        chain = VARIANT_PROMPT | get_llm().bind(max_tokens=RECIPE_MAX_TOKENS) | StrOutputParser()
+        # max_concurrency is passed explicitly so the requests run in parallel
+        variants = chain.batch(inputs, config={"max_concurrency": 5})
+        st.subheader("Recipe Variants")
+        for number, variant in enumerate(variants, 1):
+            with st.expander(f"Variant {number}"):
+                st.markdown(variant)
+
+    except Exception as e:
+        st.error(f"Error generating recipe variants: {str(e)}")
+
 # Diet adjustment section
 def adjust_recipe():
-    if not state.generated_recipe:
+    if not st.session_state.generated_recipe:
         st.error("No recipe to adjust")
         return
     
-    prompt = f"""The following recipe may not fully comply with these dietary restrictions: {', '.join(state.dietary_restrictions)}.
-
-    Recipe:
-    {state.generated_recipe}
-
-    Please adjust the recipe to strictly follow these dietary restrictions and make minimal necessary substitutions.
-    Output the adjusted recipe in the same format.
-    """
+    inputs = {
+        "restrictions": ', '.join(st.session_state.dietary_restrictions),
+        "recipe": st.session_state.generated_recipe
+    }
 
     try:
-        llm = ChatOpenAI(
-            model="gpt-3.5-turbo", 
-            temperature=0.7, 
-            api_key=openai_api_key
-        )
-
-        response = llm.invoke([HumanMessage(content=prompt)])
-        state.adjusted_recipe = response.content
+        chain = ADJUST_PROMPT | get_llm().bind(max_tokens=RECIPE_MAX_TOKENS) | StrOutputParser()
         st.subheader("Adjusted Recipe")
-        st.write(state.adjusted_recipe)
+        placeholder = st.empty()
+        st.session_state.adjusted_recipe = chain.invoke(
+            inputs,
+            config={"callbacks": [StreamHandler(placeholder)]}
+        )
+        placeholder.markdown(st.session_state.adjusted_recipe)
 
     except Exception as e:
         st.error(f"Error adjusting recipe: {str(e)}")
 
 # Ingredient substitution section
 def suggest_substitutions():
-    if not state.generated_recipe and not state.adjusted_recipe:
+    if not st.session_state.generated_recipe and not st.session_state.adjusted_recipe:
         st.error("No valid recipe to suggest substitutions for")
         return
 
-    recipe_text = state.adjusted_recipe if state.adjusted_recipe else state.generated_recipe
-    prompt = f"""
-    Analyze the following recipe and suggest ingredient substitutions that:
-    - Align with these dietary restrictions: {', '.join(state.dietary_restrictions) or 'none'}
-    - Match these preferences: {', '.join(state.preferences) or 'none'}
-
-    Recipe:
-    {recipe_text}
-
-    Return ONLY a JSON dictionary of substitutions like: {{"ingredient": "substitute"}}
-    No additional text before or after the JSON.
-    """
+    recipe_text = st.session_state.adjusted_recipe if st.session_state.adjusted_recipe else st.session_state.generated_recipe
+    inputs = {
+        "restrictions": ', '.join(st.session_state.dietary_restrictions) or 'none',
+        "preferences": ', '.join(st.session_state.preferences) or 'none',
+        "recipe": recipe_text
+    }
 
     try:
-        llm = ChatOpenAI(
-            model="gpt-3.5-turbo", 
-            temperature=0.7, 
-            api_key=openai_api_key
+        # JSON mode guarantees the response is a valid JSON object
+        llm = get_llm().bind(
+            response_format={"type": "json_object"},
+            max_tokens=SUBSTITUTION_MAX_TOKENS
         )
-
-        response = llm.invoke([HumanMessage(content=prompt)])
-        substitutions = json.loads(response.content.strip())
-        
+        chain = SUBSTITUTION_PROMPT | llm | StrOutputParser()
         st.subheader("Suggested Substitutions")
-        for ingredient, substitute in substitutions.items():
-            st.write(f"{ingredient}: {substitute}")
+        handler = SubstitutionStreamHandler(st.empty())
+        content = chain.invoke(inputs, config={"callbacks": [handler]})
+        # Cache hits return without streaming any tokens
+        if not handler.streamed:
+            handler.feed(content)
+
+        st.session_state.substitutions = handler.substitutions
+        if not st.session_state.substitutions:
+            st.error("No substitutions found in response")
 
     except Exception as e:
         st.error(f"Error suggesting substitutions: {str(e)}")
@@ -149,32 +328,59 @@ def suggest_substitutions():
 def collect_feedback():
     feedback = st.text_input("Did you face any difficulty making the recipe? (Describe or leave blank)")
     if st.button("Submit Feedback"):
-        state.user_notes = feedback
+        st.session_state.user_notes = feedback
         st.write(f"Feedback submitted: {feedback}")
 
 # Save to favorites section
 def save_to_favorites():
-    if state.adjusted_recipe or state.generated_recipe:
-        save = st.radio("Do you want to save this recipe to favorites?", ("Yes", "No"))
-        if save == "Yes":
-            if state.adjusted_recipe:
-                state.favorites.append(state.adjusted_recipe)
-            else:
-                state.favorites.append(state.generated_recipe)
-            st.write("Recipe saved to favorites!")
+    recipe = st.session_state.adjusted_recipe or st.session_state.generated_recipe
+    if recipe:
         notes = st.text_area("Any personal notes you'd like to save with it?", height=100)
+        if st.button("Save to favorites"):
+            # Keyed by content hash, so saving the same recipe twice is a no-op
+            get_favorites().add(st.session_state.owner_id, recipe, notes)
+            st.write("Recipe saved to favorites!")
         if notes:
-            state.user_notes = notes
+            st.session_state.user_notes = notes
             st.write(f"Note saved: {notes}")
     else:
         st.error("No recipe to save")
 
+# Favorites are owned by an id kept in the page URL, so they survive page
+# reloads and server restarts and the link can be bookmarked
+def get_owner_id():
+    if "owner" not in st.query_params:
+        st.query_params["owner"] = uuid.uuid4().hex
+    return st.query_params["owner"]
+
+# Favorites list section
+def show_favorites():
+    favorites = get_favorites().recent(st.session_state.owner_id)
+    st.sidebar.subheader(f"Favorites ({len(favorites)})")
+    for recipe in favorites:
+        title = recipe.strip().splitlines()[0].lstrip("# ")
+        with st.sidebar.expander(title[:40]):
+            st.markdown(recipe)
+
 # Main Streamlit app workflow
 def main():
+    for key, value in DEFAULT_STATE.items():
+        st.session_state.setdefault(key, value.copy() if isinstance(value, list) else value)
+    st.session_state.owner_id = get_owner_id()
+
     user_input()
-    if state.generated_recipe:
+    if st.session_state.generated_recipe:
         collect_feedback()
         save_to_favorites()
 
+    show_favorites()
+    # The cache is installed by the first get_llm() call
+    cache = get_llm_cache()
+    if cache is not None:
+        st.sidebar.caption(f"LLM cache: {cache.hits} hits, {cache.misses} misses")
+    recipe_cache = get_recipe_cache()
+    if recipe_cache is not None:
+        st.sidebar.caption(f"Recipe cache: {recipe_cache.hits} hits, {recipe_cache.misses} misses")
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,51 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+
+def recipe_hash(recipe: str) -> str:
+    """SHA-256 of the recipe with whitespace normalized"""
+    return hashlib.sha256(" ".join(recipe.split()).encode()).hexdigest()
+
+
+class FavoritesStore:
+    """Favorite recipes persisted in SQLite.
+
+    Rows belong to an owner (a user or session id), so one store can be
+    shared without showing anyone else's recipes or notes. Within an owner
+    recipes are keyed by their content hash, so saving the same recipe
+    again is a no-op instead of storing another copy.
+    """
+
+    def __init__(self, path: str = "favorites.db"):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS favorites("
+                "owner TEXT, h TEXT, recipe TEXT, notes TEXT, ts REAL, PRIMARY KEY (owner, h))"
+            )
+
+    def add(self, owner: str, recipe: str, notes: Optional[str] = None) -> None:
+        """Save a recipe for owner, updating its notes if any are given"""
+        h = recipe_hash(recipe)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO favorites VALUES (?, ?, ?, ?, ?)",
+                (owner, h, recipe, notes, time.time())
+            )
+            if notes:
+                self._conn.execute(
+                    "UPDATE favorites SET notes = ? WHERE owner = ? AND h = ?", (notes, owner, h)
+                )
+
+    def recent(self, owner: str, limit: int = 50) -> List[str]:
+        """Return owner's most recently saved recipes, newest first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT recipe FROM favorites WHERE owner = ? ORDER BY ts DESC LIMIT ?",
+                (owner, limit)
+            ).fetchall()
+        return [recipe for (recipe,) in rows]
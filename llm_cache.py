@@ -0,0 +1,94 @@
+import os
+from typing import Any, Dict, Optional
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.outputs import Generation
+
+# Maximum embedding distance for a semantic hit (roughly cosine similarity > 0.95)
+SEMANTIC_SCORE_THRESHOLD = 0.05
+
+# Partitions the semantic index; bump it when the recipe prompt changes so
+# recipes generated from the old prompt are no longer served
+RECIPE_CACHE_NAMESPACE = "recipe-v1"
+
+
+class CountingCache(BaseCache):
+    """Exact-match LLM cache that counts hits and misses to measure the payoff"""
+
+    def __init__(self, exact: BaseCache):
+        self.exact = exact
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        result = self.exact.lookup(prompt, llm_string)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        self.exact.update(prompt, llm_string, return_val)
+
+    def clear(self, **kwargs: Any) -> None:
+        self.exact.clear(**kwargs)
+
+
+class SemanticRecipeCache:
+    """Semantic (embedding) cache for generated recipes.
+
+    Only the canonical ingredients/restrictions/preferences string is
+    embedded, not the full prompt, and only recipe generation uses it.
+    Adjusted recipes, substitutions and variants embed mostly the same text
+    for different requests, so they stay on the exact-match cache.
+    """
+
+    def __init__(self, semantic: BaseCache):
+        self.semantic = semantic
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(inputs: Dict[str, str]) -> str:
+        return (
+            f"ingredients: {inputs['ingredients']}; restrictions: {inputs['restrictions']}; "
+            f"preferences: {inputs['preferences']}"
+        )
+
+    def lookup(self, inputs: Dict[str, str]) -> Optional[str]:
+        """Return the recipe cached for similar inputs, if any"""
+        result = self.semantic.lookup(self.key(inputs), RECIPE_CACHE_NAMESPACE)
+        if not result:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result[0].text
+
+    def update(self, inputs: Dict[str, str], recipe: str) -> None:
+        self.semantic.update(self.key(inputs), RECIPE_CACHE_NAMESPACE, [Generation(text=recipe)])
+
+
+def build_llm_cache() -> CountingCache:
+    """Build the exact-match LLM cache"""
+    # Imported here since langchain_community is slow to import
+    from langchain_community.cache import SQLiteCache
+
+    return CountingCache(SQLiteCache(database_path=".langchain_cache.db"))
+
+
+def build_recipe_cache() -> Optional[SemanticRecipeCache]:
+    """Build the semantic recipe cache, or None unless REDIS_URL is set"""
+    redis_url = os.getenv("REDIS_URL")
+    if not redis_url:
+        return None
+
+    # The semantic layer also requires the redis package
+    from langchain_community.cache import RedisSemanticCache
+    from langchain_openai import OpenAIEmbeddings
+
+    return SemanticRecipeCache(RedisSemanticCache(
+        redis_url=redis_url,
+        embedding=OpenAIEmbeddings(model="text-embedding-3-small"),
+        score_threshold=SEMANTIC_SCORE_THRESHOLD
+    ))
@@ -1,20 +1,134 @@
-from pydantic import BaseModel, Field
-from typing import Dict, Optional, List, TypedDict
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Dict, Optional, List, TypedDict, Union
 from langgraph.graph import StateGraph, START, END
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage  # Fixed import
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.globals import set_llm_cache
 from dotenv import load_dotenv
 import os
-import json
+import asyncio
+import functools
+import getpass
+import logging
+import openai
+from llm_cache import build_llm_cache, build_recipe_cache
+from favorites import FavoritesStore
+
+log = logging.getLogger(__name__)
 
 load_dotenv()
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
-# Print API key status for debugging
-if not openai_api_key:
-    print("WARNING: No OpenAI API key found in environment variables")
-else:
-    print(f"API key found (starts with: {openai_api_key[:4]}...)")
+# Cache LLM responses so repeated prompts skip the OpenAI round-trip
+llm_cache = build_llm_cache()
+set_llm_cache(llm_cache)
+
+# With REDIS_URL set, recipes for similar inputs are also served from a
+# semantic cache keyed on the canonical inputs; None otherwise. Its embeddings
+# client also needs the API key.
+recipe_cache = build_recipe_cache() if openai_api_key else None
+
+# Favorites persist across runs in SQLite, scoped to the local user
+favorites_store = FavoritesStore()
+favorites_owner = getpass.getuser()
+
+# Retry rate limits and dropped connections with exponential backoff, and fall
+# back to a second model on OpenAI server errors. Only these exception types
+# are handled, so KeyboardInterrupt and programming errors still propagate.
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)
+
+# Shared chat models; reusing one client keeps the HTTP connection pool alive.
+# They are built on first use, so a missing API key is reported by the node
+# that needs it instead of failing at import. The clients' own retries are
+# disabled since with_retry handles them.
+@functools.lru_cache(maxsize=None)
+def get_chat_models():
+    primary = ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0,
+        api_key=openai_api_key,
+        max_retries=0,
+        timeout=30
+    )
+    backup = ChatOpenAI(
+        model="gpt-3.5-turbo",
+        temperature=0,
+        api_key=openai_api_key,
+        max_retries=0,
+        timeout=30
+    )
+    return primary, backup
+
+
+def with_retry_and_fallback(primary, backup):
+    return primary.with_retry(
+        retry_if_exception_type=RETRYABLE_ERRORS,
+        wait_exponential_jitter=True,
+        stop_after_attempt=4
+    ).with_fallbacks([backup], exceptions_to_handle=(openai.InternalServerError,))
+
+
+class SubstitutionMap(BaseModel):
+    """Ingredient substitutions returned by the model"""
+    # Ignore stray fields the model adds instead of failing validation
+    model_config = ConfigDict(extra="ignore")
+
+    substitutions: Dict[str, str]
+
+
+# Output caps bound worst-case latency and cost; recipes are asked to stay
+# under 150 words and the substitutions object is short
+RECIPE_MAX_TOKENS = 400
+SUBSTITUTION_MAX_TOKENS = 150
+
+# Prompts keep the static instructions in a system message so every call
+# shares the same prefix, and ask for short answers to cut output tokens.
+# Mustache templates leave literal braces alone and triple braces insert
+# values without HTML escaping.
+RECIPE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You are a concise chef. Reply in markdown only, under 150 words."),
+    ("human", "Ingredients: {{{ingredients}}}\nRestrictions: {{{restrictions}}}\n"
+              "Preferences: {{{preferences}}}\nReturn: name, ingredients, steps.")
+], template_format="mustache")
+
+ADJUST_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "Adjust the recipe to strictly follow the dietary restrictions with minimal "
+               "substitutions. Keep the same markdown format, under 150 words."),
+    ("human", "Restrictions: {{{restrictions}}}\nRecipe:\n{{{recipe}}}")
+], template_format="mustache")
+
+SUBSTITUTION_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "Suggest ingredient substitutions for the recipe that fit the restrictions and "
+               "preferences. Reply with a JSON object whose \"substitutions\" field maps "
+               "ingredient to substitute, e.g. {\"substitutions\": {\"butter\": \"olive oil\"}}."),
+    ("human", "Restrictions: {{{restrictions}}}\nPreferences: {{{preferences}}}\n"
+              "Recipe:\n{{{recipe}}}")
+], template_format="mustache")
+
+
+@functools.lru_cache(maxsize=None)
+def get_recipe_chain():
+    llm = with_retry_and_fallback(*get_chat_models())
+    return RECIPE_PROMPT | llm.bind(max_tokens=RECIPE_MAX_TOKENS) | StrOutputParser()
+
+
+@functools.lru_cache(maxsize=None)
+def get_adjust_chain():
+    llm = with_retry_and_fallback(*get_chat_models())
+    return ADJUST_PROMPT | llm.bind(max_tokens=RECIPE_MAX_TOKENS) | StrOutputParser()
+
+
+@functools.lru_cache(maxsize=None)
+def get_substitution_chain():
+    primary, backup = get_chat_models()
+    # JSON mode guarantees valid JSON, which is then validated into SubstitutionMap
+    llm = with_retry_and_fallback(
+        primary.with_structured_output(SubstitutionMap, method="json_mode"),
+        backup.with_structured_output(SubstitutionMap, method="json_mode")
+    )
+    return SUBSTITUTION_PROMPT | llm.bind(max_tokens=SUBSTITUTION_MAX_TOKENS)
+
 
 class RecipeState(TypedDict):
     ingredients: List[str]
@@ -39,9 +153,11 @@ def user_input_node(state: RecipeState) -> Dict:
     restrictions_input = input("Enter diet restrictions separated by commas (or leave blank): ")
     preferences_input = input("Enter taste or cuisine preferences separated by commas: ")
 
-    ingredients = [item.strip() for item in ingredients_input.split(',') if item.strip()]
-    dietary_restrictions = [item.strip() for item in restrictions_input.split(',') if item.strip()]
-    preferences = [item.strip() for item in preferences_input.split(',') if item.strip()]
+    # Normalize (lowercase, de-duplicate, sort) so reordered or repeated input
+    # maps to the same cached prompt
+    ingredients = sorted({item.strip().lower() for item in ingredients_input.split(',') if item.strip()})
+    dietary_restrictions = sorted({item.strip().lower() for item in restrictions_input.split(',') if item.strip()})
+    preferences = sorted({item.strip().lower() for item in preferences_input.split(',') if item.strip()})
 
     print(f"\nIngredients: {ingredients}")
     print(f"Dietary Restrictions: {dietary_restrictions}")
@@ -54,150 +170,107 @@ def user_input_node(state: RecipeState) -> Dict:
     }
 
 
-def recipe_generation_node(state: RecipeState) -> Dict:
+def looks_malformed(ingredients: List[str]) -> bool:
+    """True when every ingredient is a single character or a number"""
+    return all(len(item) == 1 or item.isdigit() for item in ingredients)
+
+
+def simple_recipe(ingredient: str) -> str:
+    """Templated recipe for a lone ingredient, used instead of calling the LLM"""
+    return f"# Simple {ingredient} dish\n1. Season the {ingredient}.\n2. Cook until done.\n3. Serve."
+
+
+async def recipe_generation_node(state: RecipeState) -> Dict:
     """Generate a recipe based on user inputs"""
     ingredients = state.get("ingredients", [])
     dietary_restrictions = state.get("dietary_restrictions", [])
     preferences = state.get("preferences", [])
 
     if not ingredients:
-        print("No ingredients provided. Cannot generate recipe.")
+        log.warning("No ingredients provided. Cannot generate recipe.")
         return {"generated_recipe": "No ingredients provided. Cannot generate recipe."}
 
-    prompt = f"""You are a helpful chef. Create a recipe with the following ingredients: {', '.join(ingredients)}.
-    Make sure the recipe follows these dietary restrictions: {', '.join(dietary_restrictions) if dietary_restrictions else 'none'} and 
-    try to match these taste preferences: {', '.join(preferences) if preferences else 'none'}
-    
-    Provide the recipe name, ingredients list and step-by-step instructions.
-    """
+    if looks_malformed(ingredients):
+        error_message = "Error: ingredients look malformed (only single characters or numbers)"
+        log.warning("%s", error_message)
+        return {"generated_recipe": error_message}
+
+    # A lone ingredient with no restrictions or preferences doesn't need the LLM
+    if len(ingredients) == 1 and not dietary_restrictions and not preferences:
+        generated_recipe = simple_recipe(ingredients[0])
+        log.info("generated templated recipe for %s", ingredients[0])
+        return {"generated_recipe": generated_recipe}
+
+    inputs = {
+        "ingredients": ', '.join(ingredients),
+        "restrictions": ', '.join(dietary_restrictions) or 'none',
+        "preferences": ', '.join(preferences) or 'none'
+    }
 
     try:
-        # Create a new instance of the ChatOpenAI model for each request
-        llm = ChatOpenAI(
-            model="gpt-3.5-turbo", 
-            temperature=0.7, 
-            api_key=openai_api_key
-        )
-        
-        print("\nSending recipe request to OpenAI...")
-        # Send the message using the correct format
-        response = llm.invoke([HumanMessage(content=prompt)])
-        
-        # Extract content from the response
-        generated_recipe = response.content
-        
-        print("\n--- GENERATED RECIPE ---")
-        print(generated_recipe[:200] + "..." if len(generated_recipe) > 200 else generated_recipe)
-        
+        generated_recipe = recipe_cache.lookup(inputs) if recipe_cache else None
+        if generated_recipe is None:
+            log.info("sending recipe request to OpenAI")
+            generated_recipe = await get_recipe_chain().ainvoke(inputs)
+            if recipe_cache:
+                recipe_cache.update(inputs, generated_recipe)
+        log.info("generated recipe (%d chars)", len(generated_recipe))
         return {"generated_recipe": generated_recipe}
     except Exception as e:
+        log.exception("recipe generation failed")
         error_message = f"Error generating recipe: {str(e)}"
-        print(f"\nERROR: {error_message}")
-        import traceback
-        traceback.print_exc()
         return {"generated_recipe": error_message}
 
 
-def diet_adjustment_node(state: RecipeState) -> Dict:
+async def diet_adjustment_node(state: RecipeState) -> Dict:
     """Adjust recipe to dietary restrictions if needed"""
     original_recipe = state.get("generated_recipe", "")
     dietary_restrictions = state.get("dietary_restrictions", [])
 
     if not original_recipe or "Error" in original_recipe or not dietary_restrictions:
-        print("\nSkipping diet adjustment (no recipe or no dietary restrictions)")
+        log.info("skipping diet adjustment (no recipe or no dietary restrictions)")
         return {"adjusted_recipe": original_recipe}
 
-    prompt = f"""The following recipe may not fully comply with these dietary restrictions: {', '.join(dietary_restrictions)}.
-
-    Recipe:
-    {original_recipe}
-
-    Please adjust the recipe to strictly follow these dietary restrictions and make minimal necessary substitutions.
-    Output the adjusted recipe in the same format.
-    """
+    inputs = {
+        "restrictions": ', '.join(dietary_restrictions),
+        "recipe": original_recipe
+    }
 
     try:
-        llm = ChatOpenAI(
-            model="gpt-3.5-turbo", 
-            temperature=0.7, 
-            api_key=openai_api_key
-        )
-        
-        print("\nAdjusting recipe for dietary restrictions...")
-        response = llm.invoke([HumanMessage(content=prompt)])
-        adjusted_recipe = response.content
-        
-        print("\n--- ADJUSTED RECIPE ---")
-        print(adjusted_recipe[:200] + "..." if len(adjusted_recipe) > 200 else adjusted_recipe)
-        
+        log.info("adjusting recipe for dietary restrictions")
+        adjusted_recipe = await get_adjust_chain().ainvoke(inputs)
+        log.info("adjusted recipe (%d chars)", len(adjusted_recipe))
         return {"adjusted_recipe": adjusted_recipe}
-    except Exception as e:
-        error_message = f"Error adjusting recipe: {str(e)}"
-        print(f"\nERROR: {error_message}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        log.exception("diet adjustment failed")
         return {"adjusted_recipe": original_recipe}
 
 
-def ingredient_substitution_node(state: RecipeState) -> Dict:
+async def ingredient_substitution_node(state: RecipeState) -> Dict:
     """Generate substitution suggestions"""
-    recipe_text = state.get("adjusted_recipe") or state.get("generated_recipe", "")
+    # Runs alongside DietAdjustmentNode, so work from the generated recipe
+    recipe_text = state.get("generated_recipe", "")
     dietary_restrictions = state.get("dietary_restrictions", [])
     preferences = state.get("preferences", [])
 
     if not recipe_text or "Error" in recipe_text:
-        print("\nSkipping substitutions (no valid recipe)")
+        log.info("skipping substitutions (no valid recipe)")
         return {"substitutions": {}}
 
-    prompt = f"""
-    Analyze the following recipe and suggest ingredient substitutions that:
-    - Align with these dietary restrictions: {', '.join(dietary_restrictions) or 'none'}
-    - Match these preferences: {', '.join(preferences) or 'none'}
-
-    Recipe:
-    {recipe_text}
-
-    Return ONLY a JSON dictionary of substitutions like: {{"ingredient": "substitute"}}
-    No additional text before or after the JSON.
-    """
+    inputs = {
+        "restrictions": ', '.join(dietary_restrictions) or 'none',
+        "preferences": ', '.join(preferences) or 'none',
+        "recipe": recipe_text
+    }
 
     try:
-        llm = ChatOpenAI(
-            model="gpt-3.5-turbo", 
-            temperature=0.7, 
-            api_key=openai_api_key
-        )
-        
-        print("\nGenerating ingredient substitutions...")
-        response = llm.invoke([HumanMessage(content=prompt)])
-        content = response.content.strip()
-        
-        # Extract JSON from the response
-        try:
-            # Try to parse the whole string as JSON
-            substitutions = json.loads(content)
-        except json.JSONDecodeError:
-            # If that fails, look for JSON-like structure between braces
-            import re
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                try:
-                    substitutions = json.loads(json_match.group(0))
-                except json.JSONDecodeError:
-                    substitutions = {"error": "Could not parse JSON from response"}
-            else:
-                substitutions = {"error": "No JSON found in response"}
-        
-        print("\n--- SUGGESTED SUBSTITUTIONS ---")
-        for ingredient, substitute in substitutions.items():
-            print(f"- {ingredient}: {substitute}")
-            
+        log.info("generating ingredient substitutions")
+        substitutions = (await get_substitution_chain().ainvoke(inputs)).substitutions
+        log.info("suggested %d substitutions", len(substitutions))
         return {"substitutions": substitutions}
     except Exception as e:
+        log.exception("ingredient substitution failed")
         error_message = f"Failed to extract substitutions: {str(e)}"
-        print(f"\nERROR: {error_message}")
-        import traceback
-        traceback.print_exc()
         return {"substitutions": {"error": error_message}}
 
 
@@ -213,40 +286,37 @@ def storage_node(state: RecipeState) -> Dict:
     recipe = state.get("adjusted_recipe") or state.get("generated_recipe", "")
     if not recipe or "Error" in recipe:
         print("\nNo valid recipe to save")
-        return {"favorites": state.get("favorites", []), "user_notes": ""}
+        return {"favorites": favorites_store.recent(favorites_owner), "user_notes": ""}
 
     print("\n--- SAVE RECIPE ---")
     save = input("Do you want to save this recipe to favorites? (yes/no): ").strip().lower()
     notes = input("Any personal notes you'd like to save with it? (optional): ").strip()
 
-    favorites = state.get("favorites", []) or []
     if save == "yes":
-        favorites.append(recipe)
+        # Keyed by content hash, so saving the same recipe twice is a no-op
+        favorites_store.add(favorites_owner, recipe, notes)
         print("Recipe saved to favorites!")
 
     return {
-        "favorites": favorites,
+        "favorites": favorites_store.recent(favorites_owner),
         "user_notes": notes if notes else ""
     }
 
 
-def route_after_generation(state: RecipeState) -> str:
+def route_after_generation(state: RecipeState) -> Union[str, List[str]]:
     """Determine flow after recipe generation"""
     recipe = state.get("generated_recipe", "")
     if "Error" in recipe:
-        print("\nSkipping remaining nodes due to generation error")
+        log.info("skipping remaining nodes due to generation error")
         return "FeedbackNode"
-        
-    dietary_restrictions = state.get("dietary_restrictions", [])
-    if dietary_restrictions:
-        return "DietAdjustmentNode"
-    else:
-        return "IngredientSubstitutionNode"
 
+    # Both branches run in the same step; DietAdjustmentNode skips itself
+    # when there are no dietary restrictions
+    return ["DietAdjustmentNode", "IngredientSubstitutionNode"]
 
-# Main function to run the application
-def main():
-    # Build the graph
+
+def build_graph():
+    """Build and compile the recipe workflow graph"""
     graph = StateGraph(RecipeState)
 
     # Add nodes
@@ -273,13 +343,24 @@ def main():
 
     # Add regular edges
     graph.add_edge("UserInputNode", "RecipeGenerationNode")
-    graph.add_edge("DietAdjustmentNode", "IngredientSubstitutionNode")
-    graph.add_edge("IngredientSubstitutionNode", "FeedbackNode")
+    graph.add_edge(["DietAdjustmentNode", "IngredientSubstitutionNode"], "FeedbackNode")
     graph.add_edge("FeedbackNode", "StorageNode")
     graph.add_edge("StorageNode", END)
 
-    # Compile the graph
-    app = graph.compile()
+    return graph.compile()
+
+
+# Compiled once at import so repeated runs reuse the same graph
+recipe_graph = build_graph()
+
+
+# Main function to run the application
+def main():
+    # Logged here rather than at import, once LOG_LEVEL has been applied
+    if not openai_api_key:
+        log.warning("No OpenAI API key found in environment variables")
+    else:
+        log.debug("API key prefix: %s", openai_api_key[:4])
 
     # Initialize with empty state
     initial_state = {
@@ -300,18 +381,24 @@ def main():
     print("This app helps you create recipes based on available ingredients and preferences.")
     
     try:
-        # Run the graph with the initial state
-        final_state = app.invoke(initial_state)
+        # Run the graph with the initial state; the LLM nodes are async so
+        # parallel branches overlap their OpenAI requests
+        final_state = asyncio.run(recipe_graph.ainvoke(initial_state))
 
         print("\n==== Final State ====")
         for key, value in final_state.items():
             if value:  # Only print non-empty values
                 print(f"\n{key.upper()}:")
                 print(value)
-    except Exception as e:
-        print(f"\nError running the application: {str(e)}")
-        import traceback
-        traceback.print_exc()
+
+        print(f"\nLLM cache: {llm_cache.hits} hits, {llm_cache.misses} misses")
+        if recipe_cache:
+            print(f"Recipe cache: {recipe_cache.hits} hits, {recipe_cache.misses} misses")
+    except Exception:
+        log.exception("error running the application")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"), format="%(levelname)s %(message)s")
+    # httpx logs every request at INFO, which would interleave with the input() prompts
+    logging.getLogger("httpx").setLevel(logging.WARNING)
     main()
\ No newline at end of file
@@ -0,0 +1,84 @@
+import json
+
+_MISSING = object()
+
+
+class StreamingJsonParser:
+    """Incrementally parse a JSON object as it streams in from the model.
+
+    Each key/value pair becomes available from get() as soon as its value is
+    complete. Text before the opening brace (e.g. a markdown fence) and after
+    the closing brace is ignored.
+    """
+
+    def __init__(self):
+        self._result = {}
+        self._token = []
+        self._key = _MISSING
+        self._nesting = 0
+        self._started = False
+        self._in_string = False
+        self._escaped = False
+        self.done = False
+
+    def consume(self, chunk: str) -> None:
+        """Feed the next chunk of streamed text"""
+        for char in chunk:
+            if self.done:
+                return
+            self._feed(char)
+
+    def get(self) -> dict:
+        """Return the pairs parsed so far"""
+        return dict(self._result)
+
+    def _feed(self, char: str) -> None:
+        if not self._started:
+            self._started = char == "{"
+            return
+
+        if self._in_string:
+            self._token.append(char)
+            if self._escaped:
+                self._escaped = False
+            elif char == "\\":
+                self._escaped = True
+            elif char == '"':
+                self._in_string = False
+            return
+
+        if char == '"':
+            self._in_string = True
+        elif char in "{[":
+            self._nesting += 1
+        elif char in "}]" and self._nesting:
+            self._nesting -= 1
+        elif self._nesting:
+            pass
+        elif char == ":":
+            self._key = self._take_token()
+            return
+        elif char == ",":
+            self._add_pair()
+            return
+        elif char == "}":
+            self._add_pair()
+            self.done = True
+            return
+        elif char.isspace():
+            return
+        self._token.append(char)
+
+    def _take_token(self):
+        raw = "".join(self._token).strip()
+        self._token = []
+        try:
+            return json.loads(raw)
+        except json.JSONDecodeError:
+            return _MISSING
+
+    def _add_pair(self) -> None:
+        key, value = self._key, self._take_token()
+        self._key = _MISSING
+        if isinstance(key, str) and value is not _MISSING:
+            self._result[key] = value
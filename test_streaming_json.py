@@ -0,0 +1,54 @@
+from streaming_json import StreamingJsonParser
+
+
+def parse(text):
+    # Feed one character at a time, the worst case for chunk boundaries
+    parser = StreamingJsonParser()
+    for char in text:
+        parser.consume(char)
+    return parser
+
+
+def test_fenced():
+    parser = parse('Here you go:\n```json\n{"butter": "olive oil", "milk": "oat milk"}\n```\nEnjoy!')
+    assert parser.get() == {"butter": "olive oil", "milk": "oat milk"}
+    assert parser.done
+
+
+def test_nested():
+    parser = parse('{"x": {"a": [1, "}"]}, "y": "z"}')
+    assert parser.get() == {"x": {"a": [1, "}"]}, "y": "z"}
+    assert parser.done
+
+
+def test_escaped_quote():
+    parser = parse('{"milk": "oat \\"milk\\", unsweetened"}')
+    assert parser.get() == {"milk": 'oat "milk", unsweetened'}
+
+
+def test_truncated():
+    parser = parse('{"a": "b", "c": "d')
+    assert parser.get() == {"a": "b"}
+    assert not parser.done
+
+
+def test_trailing_comma():
+    parser = parse('{"a": "b",}')
+    assert parser.get() == {"a": "b"}
+    assert parser.done
+
+
+def test_trailing_text():
+    parser = parse('{"a": "b"} {"c": "d"}')
+    assert parser.get() == {"a": "b"}
+    assert parser.done
+
+
+def test_pairs_available_while_streaming():
+    parser = StreamingJsonParser()
+    seen = []
+    for char in '{"a": "b", "c": "d"}':
+        parser.consume(char)
+        seen.append(len(parser.get()))
+    assert seen.index(1) < seen.index(2)
+    assert seen[-1] == 2